@@ -1,10 +1,14 @@
 # GEX Tool - Geotiff EXtraction Tool
 #
-# Converts USGS GeoTIFF files to PNG with a 0 - 30k elevation scale, and then cuts it into tiles.
+# Converts USGS GeoTIFF files to tiled GeoTIFFs with a 0 - 30k elevation scale, and then cuts them into PNG tiles.
 # GeoTIFF conversions are saved in the input_dir. The resulting tiles, if any, are saved in output_dir.
 #
-# Currently REQUIRES the gdalinfo and gdal_translate binaries:
-# sudo apt install gdal-bin 
+# Currently REQUIRES the GDAL Python bindings:
+# sudo apt install python3-gdal
+# pip install numpy pillow
+#
+# Pillow-SIMD works as a drop-in for Pillow but doesn't speed this tool up: resizing is done by GDAL, and PNG tiles
+# are still encoded with plain zlib. It also builds from source and trails upstream Pillow releases.
 #
 # Flags:
 #     "--input_dir", help="Directory containing GeoTIFF files to be processed.", type=str
@@ -13,180 +17,260 @@
 #     "--no-alpha", help="Whether to save tiles with any transparent pixels.", type=bool
 #     "--skip-tif", help="Skips GeoTIFF file processing step.", type=bool
 #     "--debug", help="Enables verbose logging.", type=bool
+#     "--png_level", help="zlib compression level (0-9) for saved tiles. Defaults to 1.", type=int
 #
 
 import argparse
+import collections
 import concurrent.futures
 import math
+import multiprocessing
 import os
-import re
-import warnings
+from dataclasses import dataclass
 
+import numpy as np
+from osgeo import gdal
 from PIL import Image
 
-debug = False
 converted_suffix = "_GEXD"
-converted_format = "png"
+converted_driver = "GTiff"
+converted_format = "tif"
+# GEX'd files written by older versions, which GDAL can still open and cut tiles from.
+legacy_converted_format = "png"
 tile_format = "png"
+# Threads per worker process that save tiles. At most twice this many saves are queued at once.
+tile_save_workers = 8
 
+# Raise RuntimeError on GDAL failures instead of returning None.
+gdal.UseExceptions()
 
-def has_transparency(img):
-    pixels = list(img.getdata())
-    if img.mode == "P":
-        transparent = img.info.get("transparency", -1)
-        for _, index in img.getcolors():
-            if index == transparent:
-                print("Transparency detected in tile. P-mode detected.")
-                return True
-    elif img.mode == "RGBA":
-        extrema = img.getextrema()
-        if extrema[3][0] < 255:
-            print("Transparency detected in tile. RGBA image detected.")
-            return True
 
-    for pixel in pixels:
-        if pixel == 0:
-            print("Transparency detected in tile. 0-value pixel detected.")
-            return True
+# Options from the command line, passed to every worker along with each file it processes.
+@dataclass(slots=True, frozen=True)
+class Config:
+    tile_size: int
+    no_alpha: bool
+    skip_tif: bool
+    png_level: int
+    debug: bool
 
-    print("Transparency NOT detected in tile.")
-    return False
 
+def pool_initializer(gdal_threads):
+    # Runs once in every worker process. Don't list the directory of every file GDAL opens looking for sidecar
+    # files, since input_dir may hold thousands of GeoTIFFs. GDAL_CACHEMAX is left at its default, since every
+    # raster is read once in a single pass and a bigger block cache wouldn't be reused.
+    gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+    # Let GDAL decode and encode compressed blocks on this worker's share of the CPUs. GTiff's NUM_THREADS open and
+    # creation options default to this.
+    gdal.SetConfigOption("GDAL_NUM_THREADS", str(gdal_threads))
 
-def cut_tiles(input_dir, filename, output_dir, tile_size, no_alpha):
-    print(f"Cutting tiles from {filename}")
-    filepath = os.path.join(input_dir, filename)
-    img = Image.open(filepath)
-    width, height = img.size
+
+def has_transparency(cfg, band, tiles):
+    # Returns a (rows, cols) grid flagging which tiles cut from band contain any transparent pixels: 0-value pixels,
+    # or pixels matching the band's nodata value.
+    transparent_tiles = (tiles == 0).any(axis=(2, 3))
+    nodata = band.GetNoDataValue()
+    if nodata is not None and nodata != 0:
+        transparent_tiles |= (tiles == nodata).any(axis=(2, 3))
+
+    if cfg.debug:
+        print(f"DEBUG: transparency detected in {transparent_tiles.sum()}/{transparent_tiles.size} tiles.")
+    return transparent_tiles
+
+
+def cut_tiles(cfg, ds, stem, output_dir):
+    # Cuts tiles from a GEX'd dataset, either one opened from disk or one still in memory from convert_geotiff.
+    print(f"Cutting tiles from {stem}")
+    band = ds.GetRasterBand(1)
+    tile_size = cfg.tile_size
+    # Only whole tiles are cut; short tiles along the right and bottom edges are skipped.
+    rows = ds.RasterYSize // tile_size
+    cols = ds.RasterXSize // tile_size
+
+    tile_prefix = os.path.join(output_dir, stem)
     tile_count = 0
-    should_save_tile = True
-    for x in range(0, width, tile_size):
-        for y in range(0, height, tile_size):
-            tile = img.crop((x, y, x + (tile_size - 1), y + (tile_size - 1)))
-            x_f = f'{x:0>4}'
-            y_f = f'{y:0>4}'
-            suffix = f'_{x_f}_{y_f}'
-            tile_name = filename.split('.')[0] + suffix
-            # Check if alpha transparency is allowed and set should_save_tile accordingly.
-            if no_alpha:
-                should_save_tile = not has_transparency(tile)
-
-            # Save tile, if we should.
-            if should_save_tile:
-                if debug:
-                    print(f"DEBUG: saving tile {tile_name}.{tile_format}")
+    tile_saves = collections.deque()
+    try:
+        # Saving a tile is mostly zlib encoding and file IO, which PIL does without holding the GIL, so run the saves
+        # on a thread pool while the next rows are read and checked.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=tile_save_workers) as executor:
+            for row in range(rows):
+                y = row * tile_size
+                # Read one row of tiles at a time, which lines up with a row of blocks in a tiled GEX'd GeoTIFF, and
+                # view it as a (1, cols, tile_size, tile_size) grid without copying any pixels. Each read returns a new
+                # array, so tiles still waiting to be saved are never overwritten.
+                pixels = band.ReadAsArray(0, y, cols * tile_size, tile_size)
+                tiles = pixels.reshape(1, tile_size, cols, tile_size).swapaxes(1, 2)
+
+                # Check if alpha transparency is allowed and only visit the tiles that will be saved.
+                if cfg.no_alpha:
+                    save_cols = np.flatnonzero(~has_transparency(cfg, band, tiles)[0])
+                else:
+                    save_cols = range(cols)
+
+                for col in save_cols:
+                    # Rows are read much faster than tiles are encoded, so wait on the oldest save once enough are
+                    # queued rather than holding a copy of every remaining tile in memory.
+                    if len(tile_saves) >= 2 * tile_save_workers:
+                        tile_saves.popleft().result()
+                        tile_count += 1
+                    x = col * tile_size
+                    tile = Image.fromarray(tiles[0, col])
+                    tile_path = f"{tile_prefix}_{x:04d}_{y:04d}.{tile_format}"
+                    tile_saves.append(executor.submit(tile.save, tile_path, format="PNG",
+                                                      compress_level=cfg.png_level))
+
+            while tile_saves:
+                tile_saves.popleft().result()
                 tile_count += 1
-                tile_path = os.path.join(output_dir, f"{tile_name}.{tile_format}")
-                tile.save(tile_path)
+    except (OSError, RuntimeError) as e:
+        # The executor has finished the remaining saves by now, so count the ones that succeeded.
+        tile_count += sum(1 for tile_save in tile_saves if tile_save.exception() is None)
+        print(f"Error: failed to cut tiles from {stem}: {e} Skipping rest of GEX'd file!")
 
+    print(f"Saved {tile_count} tiles from {stem}")
     return tile_count
 
 
-def convert_geotiff(input_dir, filename, output_dir):
+def cut_gexd_file(cfg, input_dir, filename, output_dir):
+    filepath = os.path.join(input_dir, filename)
+    try:
+        ds = gdal.OpenEx(filepath, gdal.OF_RASTER)
+    except RuntimeError as e:
+        print(f"Error: GDAL failed to open {filename}: {e} Skipping GEX'd file!")
+        return 0
+    return cut_tiles(cfg, ds, filename.rsplit('.', 1)[0], output_dir)
+
+
+def convert_geotiff(cfg, input_dir, filename, output_dir):
     filepath = os.path.join(input_dir, filename)
     print(f"Converting: {filename}")
 
-    # Get min/max from gdalinfo
-    cmd = f'gdalinfo -mm {filepath}'
-    stream = os.popen(cmd)
-    output = stream.read()
-    match = re.search(r'Max=([0-9]*[.][0-9]*),([0-9]*[.][0-9]*)', output)
-    if match is None:
-        print("Error: no min/max elevation found with gdalinfo! Skipping GeoTIFF!")
+    try:
+        ds = gdal.OpenEx(filepath, gdal.OF_RASTER)
+    except RuntimeError as e:
+        print(f"Error: GDAL failed to open {filename}: {e} Skipping GeoTIFF!")
         return
-    else:
-        min = math.floor(float(match.group(1)))
-        max = math.floor(float(match.group(2)))
-    if debug:
+
+    # Get min/max from the first raster band.
+    try:
+        min, max = ds.GetRasterBand(1).ComputeRasterMinMax(False)
+    except RuntimeError as e:
+        print(f"Error: no min/max elevation found with GDAL: {e} Skipping GeoTIFF!")
+        return
+    min = math.floor(min)
+    max = math.floor(max)
+    if cfg.debug:
         print(f"DEBUG: elevation min: {min}")
         print(f"DEBUG: elevation max: {max}")
 
-    # Convert to PNG with correct scaling (0 to 30k)
-    # TODO: use GDAL python files instead?
-    output_filename = filename.split('.')[0] + f"{converted_suffix}.{converted_format}"
-    output_path = os.path.join(output_dir, output_filename)
-    cmd = f'gdal_translate -of {converted_format} -ot UInt16 -scale {min} {max} 0 30000 {filepath} {output_path}'
-    if debug:
-        print(f"Executing: {cmd}")
-    stream = os.popen(cmd)
-    stream.read()
-    if os.path.isfile(output_path):
-        img = Image.open(output_path)
-        width, height = img.size
-        # TODO: add a --scale_ratio flag and use it here.
-        img = img.resize((int(width / 2), int(height / 2)))
-        resize_filename = filename.split('.')[0] + f"{converted_suffix}_resized.{converted_format}"
-        img.save(os.path.join(output_dir, resize_filename))
-        # Clean up non-scaled file.
-        os.remove(output_path)
-        print(f"File GEXD! {output_path}")
-        return output_filename
-    else:
-        print("Error: converted file not found! gdal_translate may have failed to complete!")
+    # Convert to a tiled GeoTIFF with correct scaling (0 to 30k), downscaling to half size in the same pass.
+    # TODO: add a --scale_ratio flag and use it here.
+    # GeoTIFF blocks must be a multiple of 16 pixels, so round up from tile_size. When tile_size is already a multiple
+    # of 16, every tile cut from this file reads exactly one block.
+    block_size = math.ceil(cfg.tile_size / 16) * 16
+    resize_filename = filename.rsplit('.', 1)[0] + f"{converted_suffix}_resized.{converted_format}"
+    resize_path = os.path.join(output_dir, resize_filename)
+    if cfg.debug:
+        print(f"DEBUG: translating {filename} to {resize_path}")
+    try:
+        # Keep the converted raster in memory so tiles can be cut from it without reading the GEX'd file back.
+        mem_ds = gdal.Translate("", ds, format="MEM", outputType=gdal.GDT_UInt16, scaleParams=[[min, max, 0, 30000]],
+                                widthPct=50, heightPct=50, resampleAlg="average")
+        gdal.Translate(resize_path, mem_ds, format=converted_driver,
+                       creationOptions=["TILED=YES", f"BLOCKXSIZE={block_size}", f"BLOCKYSIZE={block_size}",
+                                        "COMPRESS=DEFLATE", "PREDICTOR=2"])
+    except RuntimeError as e:
+        print(f"Error: gdal.Translate failed: {e}")
         return
+    # Release the dataset so GDAL closes the source file.
+    ds = None
+
+    print(f"File GEXD! {resize_path}")
+    return mem_ds
 
 
-def gextool(input_dir, output_dir, tile_size, no_alpha, skip_tif):
+def gex_geotiff(cfg, input_dir, filename, output_dir):
+    # Converts a GeoTIFF next to the original in input_dir, then cuts tiles from the in-memory result into output_dir.
+    mem_ds = convert_geotiff(cfg, input_dir, filename, input_dir)
+    if mem_ds is None:
+        return 0
+    stem = filename.rsplit('.', 1)[0] + f"{converted_suffix}_resized"
+    return cut_tiles(cfg, mem_ds, stem, output_dir)
+
+
+def gextool(cfg, input_dir, output_dir):
     print("Running GEXtool! Your friendly neighborhood Geotiff EXtraction tool.")
 
-    # Check if output_dir exists, if not try to create it.
-    if not os.path.isdir(output_dir):
-        print(f"output_dir not found, trying to create it...")
-        os.mkdir(output_dir)
-        if not os.path.isdir(output_dir):
-            print(f"Error: failed to create output_dir: {output_dir}")
-            print("Please create output_dir and try again, or specify an dir that already exists.")
-        else:
-            print(f"Successfully created output_dir: {output_dir}")
+    # Create output_dir if it doesn't exist yet.
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+    except OSError as e:
+        print(f"Error: failed to create output_dir: {output_dir}: {e}")
+        print("Please create output_dir and try again, or specify an dir that already exists.")
+        return
+
+    # List input_dir once and sort its files into GeoTIFFs and GEX'd files. GEX'd files are GeoTIFFs too, so they
+    # are matched first.
+    # TODO: Once flag for scaling files is done, use it to set the expected format string in a var and call that.
+    resized_suffix = f"{converted_suffix}_resized.{converted_format}"
+    legacy_resized_suffix = f"{converted_suffix}_resized.{legacy_converted_format}"
+    tifs = []
+    resized = []
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if entry.name.endswith((resized_suffix, legacy_resized_suffix)):
+                resized.append(entry.name)
+            elif entry.name.endswith(".tif"):
+                tifs.append(entry.name)
 
     total_tif_count = 0
-    if skip_tif:
+    geotiff_args = []
+    if cfg.skip_tif:
         print("Skipping GeoTIFF files.")
     else:
-        # Calculate how many TIFs are present in input_dir.
-        for filename in os.listdir(input_dir):
-            if filename.endswith(".tif"):
-                total_tif_count += 1
+        total_tif_count = len(tifs)
         if total_tif_count > 0:
             print(f"{total_tif_count} TIF files found! Nice!")
 
-        # Process GeoTIFFs
         loop_count = 0
         print("Processing GeoTIFFs...")
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            geotiff_calls = []
-            for filename in os.listdir(input_dir):
-                if filename.endswith(".tif"):
-                    gexd_file = filename.split(',')[0] + f'{converted_suffix}.{converted_format}'
-                    if os.path.isfile(gexd_file):
-                        print(f"Input file has already been GEXD: {gexd_file}")
-                    else:
-                        loop_count += 1
-                        print(f"Processing {loop_count}/{total_tif_count}")
-                        geotiff_calls.append(executor.submit(convert_geotiff, input_dir, filename, input_dir))
-        concurrent.futures.as_completed(geotiff_calls)
-
-    # Calculate how many GEX'd files are present in input_dir
-    total_gexd_count = 0
-    for filename in os.listdir(input_dir):
-        if filename.endswith(f"{converted_suffix}.{converted_format}"):
-            total_gexd_count += 1
-    if total_gexd_count > 0:
-        print(f"{total_gexd_count} GEX'd PNG files found.")
-
-    # Process GEX'd files
-    print("Cutting tiles from GEX'd files...")
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        cut_tiles_calls = []
-        for filename in os.listdir(input_dir):
-            # TODO: Once flag for scaling files is done, use it to set the expected format string in a var and call that.
-            if filename.endswith(f"{converted_suffix}_resized.{converted_format}"):
-                cut_tiles_calls.append(executor.submit(cut_tiles, input_dir, filename, output_dir, tile_size, no_alpha))
-    concurrent.futures.as_completed(cut_tiles_calls)
+        already_gexd = set(resized)
+        for filename in tifs:
+            stem = filename.rsplit('.', 1)[0]
+            gexd_file = next((stem + suffix for suffix in (resized_suffix, legacy_resized_suffix)
+                              if stem + suffix in already_gexd), None)
+            if gexd_file is not None:
+                print(f"Input file has already been GEXD: {gexd_file}")
+            else:
+                loop_count += 1
+                print(f"Processing {loop_count}/{total_tif_count}")
+                geotiff_args.append((cfg, input_dir, filename, output_dir))
+
+    # Start no more workers than there are files, and split the CPUs between them for GDAL's codec threads so a big
+    # batch doesn't run cpu_count threads in each of cpu_count workers.
+    cpu_count = os.cpu_count() or 1
+    workers = max(1, min(cpu_count, len(geotiff_args) + len(resized)))
+    gdal_threads = max(1, cpu_count // workers)
+
+    tile_count = 0
+    with multiprocessing.Pool(workers, initializer=pool_initializer, initargs=(gdal_threads,)) as pool:
+        # Process GeoTIFFs, cutting tiles from each one as soon as it's converted.
+        tile_count += sum(pool.starmap(gex_geotiff, geotiff_args))
+
+        if len(resized) > 0:
+            print(f"{len(resized)} previously GEX'd files found.")
+
+        # Process previously GEX'd files
+        print("Cutting tiles from previously GEX'd files...")
+        cut_tiles_args = [(cfg, input_dir, filename, output_dir) for filename in resized]
+        tile_count += sum(pool.starmap(cut_gexd_file, cut_tiles_args))
 
     print(f"{total_tif_count} GEX'd file(s) processed.")
-    # print(f"{tile_count} tile(s) generated at {tile_size}x{tile_size}.")
-    if no_alpha:
+    print(f"{tile_count} tile(s) generated at {cfg.tile_size}x{cfg.tile_size}.")
+    if cfg.no_alpha:
         print("Tiles were NOT allowed to have any pixels with alpha transparency.")
     else:
         print("Tiles were allowed to have pixels with alpha transparency.")
@@ -194,11 +278,6 @@ def gextool(input_dir, output_dir, tile_size, no_alpha, skip_tif):
 
 
 if __name__ == '__main__':
-    # Suppress the DecompressionBombWarning since we're using very large TIFF files that trigger it.
-    # TODO: update this to raise the limit instead of suppressing the warning entirely. Not a security issue since this
-    # is only intended to run GeoTIFF files from the USGS.
-    warnings.simplefilter('ignore', Image.DecompressionBombWarning)
-
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_dir", help="Directory containing GeoTIFF files to be GEX'd.", type=str)
     parser.add_argument("--output_dir", help="Directory to save the output tiles.", type=str)
@@ -206,9 +285,12 @@ if __name__ == '__main__':
     parser.add_argument("--debug", help="Pixel width/height of tiles to be extracted from GeoTIFFs.", type=bool)
     parser.add_argument("--no-alpha", help="Whether to allow resulting tiles to contain any transparent pixels.",
                         type=bool)
-    parser.add_argument("--skip-tif", help="Whether to skip any GeoTIFFs and process only GEX'd PNGs.",
+    parser.add_argument("--skip-tif", help="Whether to skip any GeoTIFFs and process only GEX'd files.",
                         type=bool)
+    parser.add_argument("--png_level", help="zlib compression level (0-9) for saved tiles, higher is slower.",
+                        type=int, choices=range(10), metavar="0-9", default=1)
     args = parser.parse_args()
-    debug = args.debug
+    cfg = Config(tile_size=args.tile_size, no_alpha=args.no_alpha, skip_tif=args.skip_tif, png_level=args.png_level,
+                 debug=args.debug)
 
-    gextool(args.input_dir, args.output_dir, args.tile_size, args.no_alpha, args.skip_tif)
+    gextool(cfg, args.input_dir, args.output_dir)